@@ -1,22 +1,12 @@
 import streamlit as st
 import pandas as pd
-from db import fetch_df, query_db
+from db import fetch_df, cached_reader
 
-def ensure_safety_stock_column():
-    """Add safety_stock column to inventory if missing."""
-    query_db("""
-        ALTER TABLE inventory ADD COLUMN safety_stock REAL DEFAULT 0
-    """, ignore_errors=True)  # Won’t break if already exists
-
-def analyst_page():
-    st.title("📊 Business Analyst Dashboard")
-    st.write("Insights on inventory levels and restocking needs.")
-
-    # Ensure safety_stock column exists
-    ensure_safety_stock_column()
-
-    # --- Fetch inventory data with safety stock ---
-    df = fetch_df("""
+@cached_reader("inventory")
+@st.cache_data(ttl=60, show_spinner=False)
+def load_inventory_status_df():
+    """Inventory with safety stock; cached across reruns, cleared on inventory writes."""
+    return fetch_df("""
         SELECT 
             ingredient AS 'Ingredient',
             quantity AS 'Quantity',
@@ -25,17 +15,23 @@ def analyst_page():
         FROM inventory
     """)
 
+def analyst_page():
+    st.title("📊 Business Analyst Dashboard")
+    st.write("Insights on inventory levels and restocking needs.")
+
+    # --- Fetch inventory data with safety stock ---
+    df = load_inventory_status_df()
+
     if df.empty:
         st.warning("No inventory data found.")
         return
 
     # --- Check against safety stock ---
-    df["Below Safety Level?"] = df.apply(
-        lambda row: row["Quantity"] < row["Safety Stock"], axis=1
-    )
+    df[["Quantity", "Safety Stock"]] = df[["Quantity", "Safety Stock"]].fillna(0)
+    df["Below Safety Level?"] = df["Quantity"].to_numpy() < df["Safety Stock"].to_numpy()
 
     # --- Highlight critical items ---
-    low_stock_df = df[df["Below Safety Level?"] == True]
+    low_stock_df = df[df["Below Safety Level?"]]
 
     st.subheader("📉 Current Inventory Status")
     st.dataframe(df, use_container_width=True)
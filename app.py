@@ -1,29 +1,31 @@
 # app.py
 import streamlit as st
-from billing import billing_page
-from inventory import inventory_page
-from billing_history import billing_history_page
-from analyst import analyst_page
-from order_management import order_management_page          # <-- add this import
 from db import init_db
 
 st.set_page_config(page_title="Cafe POS & Inventory", layout="wide")
-init_db()
+
+init_db()  # no-op after the first successful run in this process
 
 menu = st.sidebar.radio(
     "Navigation",
     [ "Billing", "order_management", "Inventory Management", "Billing History", "Business Analyst"]  # <-- add Orders
 )
 
+# Page modules are imported only when selected
 if menu == "order_management":
+    from order_management import order_management_page
     order_management_page()
 elif menu == "Billing":
+    from billing import billing_page
     billing_page()
 elif menu == "Inventory Management":
+    from inventory import inventory_page
     inventory_page()
 elif menu == "Billing History":
+    from billing_history import billing_history_page
     billing_history_page()
 elif menu == "Business Analyst":
+    from analyst import analyst_page
     analyst_page()
 
 
@@ -2,7 +2,7 @@
 import streamlit as st
 import pandas as pd
 import uuid
-from db import init_db, query_db, fetch_df
+from db import init_db, query_db, fetch_df, values_clause, transaction, invalidate_caches
 from bom_handler import calculate_deduction, ensure_bom_seeded, INGREDIENT_UNITS
 
 # Product list
@@ -23,10 +23,35 @@ PRODUCTS = [
 ]
 
 # Quick lookup mappings
-PRODUCT_OPTIONS = [f"{p['product_id']} — {p['name']}" for p in PRODUCTS]
-PID_BY_LABEL = {opt: p['product_id'] for opt, p in zip(PRODUCT_OPTIONS, PRODUCTS)}
-NAME_BY_LABEL = {opt: p['name'] for opt, p in zip(PRODUCT_OPTIONS, PRODUCTS)}
-PRICE_BY_LABEL = {opt: p['price'] for opt, p in zip(PRODUCT_OPTIONS, PRODUCTS)}
+PRODUCT_BY_LABEL = {
+    f"{p['product_id']} — {p['name']}": (p['product_id'], p['name'], p['price']) for p in PRODUCTS
+}
+PRODUCT_OPTIONS = tuple(PRODUCT_BY_LABEL)
+
+# Arrow-backed dtypes for the cart table handed to Streamlit
+CART_DTYPES = {
+    "product_id": "string[pyarrow]",
+    "product_name": "string[pyarrow]",
+    "quantity": "int32",
+    "unit_price": "float64",
+    "total": "float64",
+}
+
+_INSERT_BILLING_SQL = """
+    INSERT INTO billing
+    (invoice_id, customer_id, product_id, product_name, quantity, unit_price, total, [timestamp])
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+@st.cache_data(ttl=30, show_spinner=False)
+def lookup_customer(customer_number: str):
+    """Return (customer_id, customer_name) for a customer number, or None if unknown."""
+    row = query_db(
+        "SELECT customer_id, customer_name FROM customers WHERE customer_number=?",
+        (customer_number,), fetch=True
+    )
+    return (row[0][0], row[0][1]) if row else None
 
 
 def get_or_create_customer(customer_number: str, customer_name: str | None):
@@ -36,38 +61,65 @@ def get_or_create_customer(customer_number: str, customer_name: str | None):
         return None, None
 
     # Check if exists
-    row = query_db(
-        "SELECT customer_id, customer_name FROM customers WHERE customer_number=?",
-        (customer_number,), fetch=True
-    )
-    if row:
-        return row[0][0], row[0][1]
+    existing = lookup_customer(customer_number)
+    if existing:
+        return existing
 
     # Require name for new
     if not customer_name or not customer_name.strip():
         return None, None
 
-    # Create
-    count = query_db("SELECT COUNT(*) FROM customers", fetch=True)[0][0]
-    new_id = f"CUST-{count + 1:04d}"
-    query_db(
-        "INSERT INTO customers (customer_id, customer_number, customer_name) VALUES (?, ?, ?)",
-        (new_id, customer_number, customer_name.strip())
-    )
-    return new_id, customer_name.strip()
-
-
-def ensure_inventory_rows_exist(ingredients: list[str]):
-    """Ensure each ingredient exists in inventory; insert with 0 quantity if missing."""
-    for ing in ingredients:
-        unit = INGREDIENT_UNITS.get(ing, "")
-        query_db("""
-            MERGE inventory AS target
-            USING (SELECT ? AS ingredient, CAST(0 AS FLOAT) AS quantity, ? AS unit) AS source
-            ON target.ingredient = source.ingredient
-            WHEN NOT MATCHED THEN
-                INSERT (ingredient, quantity, unit) VALUES (source.ingredient, source.quantity, source.unit);
-        """, (ing, unit))
+    # Create, or pick up a row another session just created, in one statement
+    # (customer_id comes from the customer_seq default)
+    row = query_db("""
+        MERGE customers WITH (HOLDLOCK) AS target
+        USING (SELECT ? AS customer_number, ? AS customer_name) AS source
+        ON target.customer_number = source.customer_number
+        WHEN MATCHED THEN
+            UPDATE SET customer_name = target.customer_name
+        WHEN NOT MATCHED THEN
+            INSERT (customer_number, customer_name) VALUES (source.customer_number, source.customer_name)
+        OUTPUT INSERTED.customer_id, INSERTED.customer_name;
+    """, (customer_number, customer_name.strip()), fetch=True)
+    lookup_customer.clear()
+    return row[0][0], row[0][1]
+
+
+def deduct_inventory(cur, deduction: dict[str, float]):
+    """Subtract quantities from inventory, creating missing ingredient rows, in one MERGE."""
+    if not deduction:
+        return
+    values_sql, params = values_clause([
+        (ing, float(dec_qty), INGREDIENT_UNITS.get(ing, "")) for ing, dec_qty in deduction.items()
+    ])
+    cur.execute(f"""
+        MERGE inventory AS target
+        USING (VALUES {values_sql}) AS source (ingredient, dec, unit)
+        ON target.ingredient = source.ingredient
+        WHEN MATCHED THEN
+            UPDATE SET quantity = ISNULL(target.quantity, 0) - source.dec
+        WHEN NOT MATCHED THEN
+            INSERT (ingredient, quantity, unit) VALUES (source.ingredient, -source.dec, source.unit);
+    """, params)
+
+
+def _apply_cart_edits():
+    """Fold quantity edits from the cart editor back into the session cart; quantity 0 removes the line."""
+    changes = st.session_state[f"cart_editor_{st.session_state.cart_version}"]
+    cart = st.session_state.cart
+    pids = list(cart)  # editor rows are positional, in cart order
+    for idx, edits in changes["edited_rows"].items():
+        if edits.get("quantity") is None:
+            continue
+        pid = pids[int(idx)]
+        qty = int(edits["quantity"])
+        if qty <= 0:
+            del cart[pid]
+            continue
+        cart[pid]["quantity"] = qty
+        cart[pid]["total"] = cart[pid]["unit_price"] * qty
+    # New editor key so the applied edits are not replayed on the updated cart
+    st.session_state.cart_version += 1
 
 
 def billing_page():
@@ -75,7 +127,9 @@ def billing_page():
     ensure_bom_seeded()
 
     if "cart" not in st.session_state:
-        st.session_state.cart = []
+        st.session_state.cart = {}  # product_id -> line item
+    if "cart_version" not in st.session_state:
+        st.session_state.cart_version = 0
 
     st.header("🧾 Cafe Billing")
 
@@ -85,13 +139,17 @@ def billing_page():
         label = col1.selectbox("Product", PRODUCT_OPTIONS, index=0)
         qty = col2.number_input("Quantity", min_value=1, value=1, step=1)
         if st.form_submit_button("Add to Cart"):
-            st.session_state.cart.append({
-                "product_id": PID_BY_LABEL[label],
-                "product_name": NAME_BY_LABEL[label],
-                "quantity": int(qty),
-                "unit_price": PRICE_BY_LABEL[label],
-                "total": PRICE_BY_LABEL[label] * int(qty)
+            pid, name, price = PRODUCT_BY_LABEL[label]
+            # Adding a product already in the cart raises its quantity
+            item = st.session_state.cart.setdefault(pid, {
+                "product_id": pid,
+                "product_name": name,
+                "quantity": 0,
+                "unit_price": price,
+                "total": 0,
             })
+            item["quantity"] += int(qty)
+            item["total"] = price * item["quantity"]
             st.success("Item added to cart.")
 
     # Stop if empty
@@ -100,25 +158,20 @@ def billing_page():
 
     # Cart display
     st.subheader("🛒 Current Cart")
-    st.markdown("""
-        <style>
-        button[title="Remove"] {
-            font-size: 0.8rem !important;
-            padding: 0.1rem 0.3rem !important;
-            color: red !important;
-        }
-        </style>
-    """, unsafe_allow_html=True)
-
-    for idx, item in enumerate(st.session_state.cart):
-        col1, col2, col3, col4, col5 = st.columns([3, 2, 2, 2, 0.5])
-        col1.write(item["product_name"])
-        col2.write(f"Qty: {item['quantity']}")
-        col3.write(f"Unit: ${item['unit_price']:.2f}")
-        col4.write(f"Total: ${item['total']:.2f}")
-        if col5.button("❌", key=f"remove_{idx}", help="Remove", type="secondary"):
-            st.session_state.cart.pop(idx)
-            st.rerun()
+    st.data_editor(
+        pd.DataFrame(list(st.session_state.cart.values())).astype(CART_DTYPES),
+        key=f"cart_editor_{st.session_state.cart_version}",
+        on_change=_apply_cart_edits,
+        num_rows="fixed",
+        disabled=["product_id", "product_name", "unit_price", "total"],
+        column_config={
+            "quantity": st.column_config.NumberColumn(
+                "quantity", min_value=0, step=1, required=True, help="Set to 0 to remove the item"
+            ),
+        },
+        hide_index=True,
+        use_container_width=True,
+    )
 
     # Customer details
     st.subheader("👤 Customer Details")
@@ -127,10 +180,9 @@ def billing_page():
     new_name = ""
 
     if customer_number:
-        row = query_db("SELECT customer_name FROM customers WHERE customer_number=?",
-                       (customer_number,), fetch=True)
-        if row:
-            auto_name = row[0][0]
+        existing = lookup_customer(customer_number)
+        if existing:
+            auto_name = existing[1]
             st.info(f"Existing customer: {auto_name}")
         else:
             new_name = st.text_input("Customer Name (New Customer)")
@@ -151,26 +203,19 @@ def billing_page():
         invoice_id = str(uuid.uuid4())
         ts = pd.Timestamp.now().strftime("%Y-%m-%d %H:%M:%S")
 
-        # Save billing
-        for item in st.session_state.cart:
-            query_db("""
-                INSERT INTO billing
-                (invoice_id, customer_id, product_id, product_name, quantity, unit_price, total, [timestamp])
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                invoice_id, cust_id, item["product_id"], item["product_name"],
-                int(item["quantity"]), float(item["unit_price"]), float(item["total"]), ts
-            ))
-
-        # Deduct from inventory
-        deduction = calculate_deduction(st.session_state.cart)
-        if deduction:
-            ensure_inventory_rows_exist(list(deduction.keys()))
-            for ing, dec_qty in deduction.items():
-                query_db(
-                    "UPDATE inventory SET quantity = ISNULL(quantity, 0) - ? WHERE ingredient = ?",
-                    (float(dec_qty), ing)
-                )
+        rows = [
+            (invoice_id, cust_id, item["product_id"], item["product_name"],
+             int(item["quantity"]), float(item["unit_price"]), float(item["total"]), ts)
+            for item in st.session_state.cart.values()
+        ]
+        deduction = calculate_deduction(list(st.session_state.cart.values()))
+
+        # Save billing and deduct from inventory as one transaction
+        with transaction() as cur:
+            cur.fast_executemany = True
+            cur.executemany(_INSERT_BILLING_SQL, rows)
+            deduct_inventory(cur, deduction)
+        invalidate_caches("billing", "inventory", "orders")
 
         st.success(f"Invoice {invoice_id} saved for Customer {cust_id}. Inventory updated.")
-        st.session_state.cart = []
+        st.session_state.cart = {}
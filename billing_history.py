@@ -1,50 +1,29 @@
 # billing_history.py
+import gzip
+import io
 import os
-from datetime import datetime
+from datetime import date, datetime, timedelta
 import streamlit as st
 import pyodbc
 import pandas as pd
+import pyarrow as pa
+import pyarrow.csv as pa_csv
 import sqlite3
 
+from db import pooled_connection, cached_reader, invalidate_caches, stage_rows
+
 # =========================================================
 # CONFIGURATION
 # =========================================================
-SERVER = st.secrets.get("MSSQL_SERVER", "den1.mssql7.gear.host")
-DATABASE = st.secrets.get("MSSQL_DATABASE", "billinghistory")
-USERNAME = st.secrets.get("MSSQL_USERNAME", "billinghistory")
-PASSWORD = st.secrets.get("MSSQL_PASSWORD", "Pk0Z-57_avQe")
 LOCAL_DB_FILE = "data/cafe_pos.db"
 
-# =========================================================
-# SQL SERVER CONNECTION
-# =========================================================
-def detect_sql_driver() -> str:
-    """Detect the latest available SQL Server ODBC driver."""
-    drivers = [d for d in pyodbc.drivers() if "SQL Server" in d]
-    if not drivers:
-        raise RuntimeError("No SQL Server ODBC drivers found.")
-    return drivers[-1]
-
-def get_sql_connection() -> pyodbc.Connection:
-    """Connect to SQL Server."""
-    driver = detect_sql_driver()
-    conn_str = (
-        f"Driver={{{driver}}};"
-        f"Server={SERVER};"
-        f"Database={DATABASE};"
-        f"UID={USERNAME};"
-        f"PWD={PASSWORD};"
-        "Encrypt=yes;"
-        "TrustServerCertificate=yes;"
-    )
-    return pyodbc.connect(conn_str)
-
 # =========================================================
 # DATABASE INITIALIZATION
 # =========================================================
+@st.cache_resource(show_spinner=False)
 def ensure_tables_exist():
-    """Ensure all required tables exist on SQL Server."""
-    with get_sql_connection() as conn:
+    """Ensure all required tables exist on SQL Server (once per process; retried if it fails)."""
+    with pooled_connection() as conn:
         cur = conn.cursor()
 
         cur.execute("""
@@ -82,104 +61,233 @@ def ensure_tables_exist():
             );
         """)
 
+        # Covering index so "latest N" history reads are a range scan, not a sort
+        cur.execute("""
+            IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name='IX_billing_ts' AND object_id=OBJECT_ID('billing'))
+            CREATE INDEX IX_billing_ts ON billing([timestamp] DESC)
+                INCLUDE (invoice_id, customer_id, product_id, product_name, quantity, unit_price, total);
+        """)
+
         conn.commit()
 
 # =========================================================
 # FETCH HELPERS
 # =========================================================
-def fetch_server_billing_df() -> pd.DataFrame:
-    """Retrieve billing history from SQL Server."""
+@cached_reader("billing")
+@st.cache_data(ttl=30, show_spinner=False)
+def fetch_server_billing_df(date_from: date, date_to: date, limit: int = 1000) -> pd.DataFrame:
+    """
+    Retrieve the latest `limit` billing rows between two dates (inclusive) from SQL Server.
+    Cached; cleared after billing writes.
+    """
     query = """
-        SELECT b.invoice_id, b.[timestamp], c.customer_id, c.customer_name, c.customer_number,
+        SELECT TOP (?) b.invoice_id, b.[timestamp], c.customer_id, c.customer_name, c.customer_number,
                b.product_id, b.product_name, b.quantity, b.unit_price, b.total
         FROM billing b
         LEFT JOIN customers c ON b.customer_id = c.customer_id
-        ORDER BY b.[timestamp] DESC;
+        WHERE b.[timestamp] >= ? AND b.[timestamp] < ?
+        ORDER BY b.[timestamp] DESC
+        OPTION (RECOMPILE);
     """
-    with get_sql_connection() as conn:
-        return pd.read_sql(query, conn)
+    # Date-only ISO strings compare correctly whether [timestamp] is DATETIME or text
+    params = [int(limit), f"{date_from:%Y-%m-%d}", f"{date_to + timedelta(days=1):%Y-%m-%d}"]
+    with pooled_connection() as conn:
+        return pd.read_sql(query, conn, params=params, dtype_backend="pyarrow")
 
-def fetch_existing_customer_ids() -> set:
-    """Get set of all existing customer IDs."""
-    with get_sql_connection() as conn:
-        cur = conn.cursor()
-        cur.execute("SELECT customer_id FROM customers;")
-        return {row[0] for row in cur.fetchall()}
+def to_csv_gz(df: pd.DataFrame) -> bytes:
+    """Encode a DataFrame as gzip-compressed CSV using Arrow's native CSV writer."""
+    buf = io.BytesIO()
+    with gzip.GzipFile(fileobj=buf, mode="wb") as gz:
+        pa_csv.write_csv(pa.Table.from_pandas(df, preserve_index=False), gz)
+    return buf.getvalue()
 
 # =========================================================
 # UPSERT OPERATIONS
 # =========================================================
-def upsert_customers(df: pd.DataFrame) -> int:
-    """Insert only new customers."""
+# Stage + MERGE statements are built once per process; rows are loaded with db.stage_rows.
+_BILLING_STAGE_SQL = """
+    DROP TABLE IF EXISTS #billing_stage;
+    CREATE TABLE #billing_stage (
+        invoice_id NVARCHAR(255),
+        [timestamp] NVARCHAR(50),
+        customer_id NVARCHAR(255),
+        product_id NVARCHAR(255),
+        product_name NVARCHAR(255),
+        quantity INT,
+        unit_price FLOAT,
+        total FLOAT
+    );
+"""
+_BILLING_STAGE_INSERT = "INSERT INTO #billing_stage VALUES (?, ?, ?, ?, ?, ?, ?, ?);"
+_BILLING_STAGE_TYPES = [
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # invoice_id
+    (pyodbc.SQL_WVARCHAR, 50, 0),   # timestamp
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # customer_id
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # product_id
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # product_name
+    (pyodbc.SQL_INTEGER, 0, 0),     # quantity
+    (pyodbc.SQL_DOUBLE, 0, 0),      # unit_price
+    (pyodbc.SQL_DOUBLE, 0, 0),      # total
+]
+_BILLING_MERGE_SQL = """
+    MERGE billing WITH (TABLOCK) AS tgt
+    USING #billing_stage AS src
+    ON tgt.invoice_id = src.invoice_id AND tgt.product_id = src.product_id
+    WHEN MATCHED THEN UPDATE SET
+        [timestamp] = src.[timestamp],
+        customer_id = src.customer_id,
+        product_name = src.product_name,
+        quantity = src.quantity,
+        unit_price = src.unit_price,
+        total = src.total
+    WHEN NOT MATCHED THEN INSERT
+        (invoice_id, [timestamp], customer_id, product_id, product_name, quantity, unit_price, total)
+        VALUES (src.invoice_id, src.[timestamp], src.customer_id, src.product_id, src.product_name, src.quantity, src.unit_price, src.total);
+"""
+
+_INVENTORY_STAGE_SQL = """
+    DROP TABLE IF EXISTS #sync_inv_stage;
+    CREATE TABLE #sync_inv_stage (
+        ingredient NVARCHAR(255) PRIMARY KEY,
+        quantity FLOAT,
+        unit NVARCHAR(50)
+    );
+"""
+_INVENTORY_STAGE_INSERT = "INSERT INTO #sync_inv_stage VALUES (?, ?, ?);"
+_INVENTORY_STAGE_TYPES = [
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # ingredient
+    (pyodbc.SQL_DOUBLE, 0, 0),      # quantity
+    (pyodbc.SQL_WVARCHAR, 50, 0),   # unit
+]
+_INVENTORY_MERGE_SQL = """
+    MERGE inventory AS tgt
+    USING #sync_inv_stage AS src
+    ON tgt.ingredient = src.ingredient
+    WHEN MATCHED THEN UPDATE SET
+        quantity = src.quantity,
+        unit = src.unit
+    WHEN NOT MATCHED BY TARGET THEN INSERT (ingredient, quantity, unit)
+        VALUES (src.ingredient, src.quantity, src.unit)
+    WHEN NOT MATCHED BY SOURCE THEN DELETE;
+"""
+
+def _none_if_na(value):
+    """Map pandas missing values (NaN/NaT/None) to None for ODBC parameters."""
+    return None if pd.isna(value) else value
+
+# Explicit CUST-NNNN ids copied from the local db never draw from customer_seq, so move
+# the sequence (created in db.init_db) past them or the next default id collides
+_CUSTOMER_SEQ_SYNC_SQL = """
+    IF EXISTS (SELECT 1 FROM sys.sequences WHERE name = 'customer_seq')
+    BEGIN
+        DECLARE @next INT = (
+            SELECT ISNULL(MAX(TRY_CAST(SUBSTRING(customer_id, 6, 20) AS INT)), 0) + 1
+            FROM customers WHERE customer_id LIKE 'CUST-%'
+        );
+        IF @next > (SELECT CAST(current_value AS INT) FROM sys.sequences WHERE name = 'customer_seq')
+        BEGIN
+            DECLARE @sql NVARCHAR(200) =
+                N'ALTER SEQUENCE customer_seq RESTART WITH ' + CAST(@next AS NVARCHAR(20));
+            EXEC sp_executesql @sql;
+        END
+    END
+"""
+
+_CUSTOMER_STAGE_SQL = """
+    DROP TABLE IF EXISTS #cust_stage;
+    CREATE TABLE #cust_stage (
+        customer_id NVARCHAR(255),
+        customer_name NVARCHAR(255),
+        customer_number NVARCHAR(255)
+    );
+"""
+_CUSTOMER_STAGE_INSERT = "INSERT INTO #cust_stage VALUES (?, ?, ?);"
+_CUSTOMER_STAGE_TYPES = [
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # customer_id
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # customer_name
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # customer_number
+]
+
+def upsert_customers(cur, df: pd.DataFrame) -> int:
+    """Insert only new customers; the existence check runs on the server."""
     if df.empty or "customer_id" not in df:
         return 0
 
-    existing_ids = fetch_existing_customer_ids()
-    new_customers = df[~df["customer_id"].isin(existing_ids)]
-
-    if new_customers.empty:
+    # One row per id: duplicates would collide on the customers primary key
+    df = df.dropna(subset=["customer_id"]).drop_duplicates(subset="customer_id")
+    if df.empty:
         return 0
 
-    with get_sql_connection() as conn:
-        cur = conn.cursor()
-        for _, row in new_customers.iterrows():
-            cur.execute("""
-                INSERT INTO customers (customer_id, customer_name, customer_number)
-                VALUES (?, ?, ?);
-            """, (row["customer_id"], row.get("customer_name"), row.get("customer_number")))
-        conn.commit()
+    params = [
+        (r.customer_id, _none_if_na(r.customer_name), _none_if_na(r.customer_number))
+        for r in df.reindex(
+            columns=["customer_id", "customer_name", "customer_number"]
+        ).itertuples(index=False)
+    ]
+    stage_rows(cur, _CUSTOMER_STAGE_SQL, _CUSTOMER_STAGE_INSERT, _CUSTOMER_STAGE_TYPES, params)
+    cur.execute("""
+        INSERT INTO customers (customer_id, customer_name, customer_number)
+        SELECT s.customer_id, s.customer_name, s.customer_number
+        FROM #cust_stage s
+        WHERE NOT EXISTS (SELECT 1 FROM customers c WHERE c.customer_id = s.customer_id);
+    """)
+    inserted = cur.rowcount
+    cur.execute("DROP TABLE #cust_stage;")
+    if inserted:
+        cur.execute(_CUSTOMER_SEQ_SYNC_SQL)
 
-    return len(new_customers)
+    return inserted
 
-def upsert_billing(df: pd.DataFrame):
+def upsert_billing(cur, df: pd.DataFrame):
     """Insert or update billing records."""
     if df.empty:
         return
 
     required_cols = ["invoice_id", "timestamp", "customer_id", "product_id", 
                      "product_name", "quantity", "unit_price", "total"]
-    for col in required_cols:
-        if col not in df.columns:
-            df[col] = None
+    # Missing columns come back as all-NaN in one pass; the caller's frame is left untouched
+    df = df.reindex(columns=required_cols)
 
-    with get_sql_connection() as conn:
-        cur = conn.cursor()
-        for _, r in df.drop_duplicates(subset=["invoice_id", "product_id"]).iterrows():
-            cur.execute("""
-                MERGE billing AS tgt
-                USING (SELECT ? AS invoice_id, ? AS [timestamp], ? AS customer_id,
-                              ? AS product_id, ? AS product_name, ? AS quantity,
-                              ? AS unit_price, ? AS total) AS src
-                ON tgt.invoice_id = src.invoice_id AND tgt.product_id = src.product_id
-                WHEN MATCHED THEN UPDATE SET
-                    [timestamp] = src.[timestamp],
-                    customer_id = src.customer_id,
-                    product_name = src.product_name,
-                    quantity = src.quantity,
-                    unit_price = src.unit_price,
-                    total = src.total
-                WHEN NOT MATCHED THEN INSERT
-                    (invoice_id, [timestamp], customer_id, product_id, product_name, quantity, unit_price, total)
-                    VALUES (src.invoice_id, src.[timestamp], src.customer_id, src.product_id, src.product_name, src.quantity, src.unit_price, src.total);
-            """, (
-                r["invoice_id"], r["timestamp"], r["customer_id"], r["product_id"],
-                r.get("product_name"), int(r["quantity"]) if pd.notna(r["quantity"]) else None,
-                float(r["unit_price"]) if pd.notna(r["unit_price"]) else None,
-                float(r["total"]) if pd.notna(r["total"]) else None
-            ))
-        conn.commit()
+    params = [
+        (
+            r.invoice_id, _none_if_na(r.timestamp), _none_if_na(r.customer_id), r.product_id,
+            _none_if_na(r.product_name), int(r.quantity) if pd.notna(r.quantity) else None,
+            float(r.unit_price) if pd.notna(r.unit_price) else None,
+            float(r.total) if pd.notna(r.total) else None,
+        )
+        for r in df.drop_duplicates(subset=["invoice_id", "product_id"]).itertuples(index=False)
+    ]
+
+    # Stage all rows, then apply them with one set-based MERGE
+    stage_rows(cur, _BILLING_STAGE_SQL, _BILLING_STAGE_INSERT, _BILLING_STAGE_TYPES, params)
+    cur.execute(_BILLING_MERGE_SQL)
+    cur.execute("DROP TABLE #billing_stage;")
+
+def replace_inventory(cur, items: list[dict]):
+    """Replace inventory table content with new data, without an empty-table window."""
+    stage_rows(
+        cur, _INVENTORY_STAGE_SQL, _INVENTORY_STAGE_INSERT, _INVENTORY_STAGE_TYPES,
+        [(it["ingredient"], float(it.get("quantity", 0)), it.get("unit")) for it in items],
+    )
+    cur.execute(_INVENTORY_MERGE_SQL)
+    cur.execute("DROP TABLE #sync_inv_stage;")
 
-def replace_inventory(items: list[dict]):
-    """Replace inventory table content with new data."""
-    with get_sql_connection() as conn:
+def sync_local_to_server(df_local: pd.DataFrame, inventory_items: list[dict]) -> int:
+    """Push customers, billing and inventory to SQL Server as one transaction."""
+    with pooled_connection() as conn:
+        conn.autocommit = False
         cur = conn.cursor()
-        cur.execute("TRUNCATE TABLE inventory;")
-        for it in items:
-            cur.execute("""
-                INSERT INTO inventory (ingredient, quantity, unit)
-                VALUES (?, ?, ?);
-            """, (it["ingredient"], float(it.get("quantity", 0)), it.get("unit")))
-        conn.commit()
+        try:
+            inserted = upsert_customers(
+                cur, df_local[["customer_id", "customer_name", "customer_number"]].drop_duplicates()
+            )
+            upsert_billing(cur, df_local)
+            replace_inventory(cur, inventory_items)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+    return inserted
 
 # =========================================================
 # LOCAL SQLITE HELPERS
@@ -189,7 +297,7 @@ def fetch_local_sqlite_df(sql: str, params: tuple = ()) -> pd.DataFrame:
     if not os.path.exists(LOCAL_DB_FILE):
         return pd.DataFrame()
     with sqlite3.connect(LOCAL_DB_FILE) as conn:
-        return pd.read_sql_query(sql, conn, params=params)
+        return pd.read_sql_query(sql, conn, params=params, dtype_backend="pyarrow")
 
 def load_local_billing_snapshot() -> pd.DataFrame:
     """Get billing history from local SQLite."""
@@ -218,17 +326,21 @@ def billing_history_page():
 
     # --- TAB 1 ---
     with tabs[0]:
+        col1, col2, col3 = st.columns(3)
+        date_from = col1.date_input("From", value=date.today() - timedelta(days=30))
+        date_to = col2.date_input("To", value=date.today())
+        max_rows = col3.number_input("Max rows", min_value=100, max_value=100_000, value=1000, step=100)
         try:
-            df_server = fetch_server_billing_df()
+            df_server = fetch_server_billing_df(date_from, date_to, int(max_rows))
             if df_server.empty:
                 st.info("No billing records found on server.")
             else:
                 st.dataframe(df_server, use_container_width=True)
                 st.download_button(
-                    "⬇ Download CSV",
-                    df_server.to_csv(index=False).encode("utf-8"),
-                    file_name=f"billing_history_{datetime.utcnow():%Y%m%d_%H%M%S}Z.csv",
-                    mime="text/csv"
+                    "⬇ Download CSV (gzip)",
+                    to_csv_gz(df_server),
+                    file_name=f"billing_history_{datetime.utcnow():%Y%m%d_%H%M%S}Z.csv.gz",
+                    mime="application/gzip"
                 )
         except Exception as e:
             st.error(f"Error fetching from SQL Server: {e}")
@@ -253,11 +365,8 @@ def billing_history_page():
 
                 if st.button("📤 Sync Local → Server"):
                     try:
-                        inserted_count = upsert_customers(
-                            df_local[["customer_id", "customer_name", "customer_number"]].drop_duplicates()
-                        )
-                        upsert_billing(df_local)
-                        replace_inventory(sample_inventory)
+                        inserted_count = sync_local_to_server(df_local, sample_inventory)
+                        invalidate_caches("billing", "inventory")  # sync also rewrites inventory
                         st.success(f"✅ Sync complete. {inserted_count} new customers inserted.")
                     except Exception as e:
                         st.error(f"❌ Sync failed: {e}")
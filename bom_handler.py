@@ -1,4 +1,6 @@
 # bom_handler.py
+import streamlit as st
+import pandas as pd
 from db import init_db, query_db, fetch_df
 from typing import List, Dict
 
@@ -35,11 +37,17 @@ DEFAULT_BOM = {
     }
 }
 
+_BOM_SEEDED = False  # set once the bom table is known to be populated in this process
+
 def ensure_bom_seeded():
     """Seed the BOM table once if empty."""
+    global _BOM_SEEDED
+    if _BOM_SEEDED:
+        return
     init_db()
     existing = query_db("SELECT COUNT(*) FROM bom", fetch=True)
     if existing and existing[0][0] > 0:
+        _BOM_SEEDED = True
         return
 
     rows = []
@@ -53,6 +61,13 @@ def ensure_bom_seeded():
             INSERT INTO bom (product_id, ingredient, qty_per_unit, unit)
             VALUES (?, ?, ?, ?)
         """, many=True, seq=rows)
+        load_bom_df.clear()
+    _BOM_SEEDED = True
+
+@st.cache_data(ttl=300, show_spinner=False)
+def load_bom_df() -> pd.DataFrame:
+    """Full BOM table (product_id, ingredient, qty_per_unit), cached across reruns."""
+    return fetch_df("SELECT product_id, ingredient, qty_per_unit FROM bom")
 
 def calculate_deduction(cart: List[Dict]) -> Dict[str, float]:
     """
@@ -60,14 +75,10 @@ def calculate_deduction(cart: List[Dict]) -> Dict[str, float]:
     returns {ingredient: total_qty_to_deduct}
     """
     ensure_bom_seeded()
-    deduction = {}
-    for item in cart:
-        pid = item["product_id"]
-        qty = float(item["quantity"])
-        # fetch BOM for product
-        df = fetch_df("SELECT ingredient, qty_per_unit FROM bom WHERE product_id=?", (pid,))
-        for _, row in df.iterrows():
-            ing = row["ingredient"]
-            per_unit = float(row["qty_per_unit"])
-            deduction[ing] = deduction.get(ing, 0.0) + per_unit * qty
-    return deduction
+    if not cart:
+        return {}
+    # join cart lines to their BOM rows and sum per ingredient
+    cart_df = pd.DataFrame(cart, columns=["product_id", "quantity"])
+    merged = cart_df.merge(load_bom_df(), on="product_id")
+    per_line = merged["qty_per_unit"].astype(float) * merged["quantity"].astype(float)
+    return per_line.groupby(merged["ingredient"]).sum().to_dict()
@@ -1,27 +1,105 @@
 import os
+import queue
+from contextlib import contextmanager
+from functools import lru_cache
 import pandas as pd
 import pyodbc
 from datetime import datetime
 
-# Remote SQL Server connection details
-SERVER = "den1.mssql7.gear.host"
-DATABASE = "billinghistory"
-USERNAME = "billinghistory"
-PASSWORD = "Pk0Z-57_avQe"  
+# Remote SQL Server connection details. Every module reads these same MSSQL_* names,
+# from the environment or .streamlit/secrets.toml (see secrets.toml.example); nothing is hardcoded.
+SQL_SETTINGS = ("MSSQL_SERVER", "MSSQL_DATABASE", "MSSQL_USERNAME", "MSSQL_PASSWORD")
+
+def _setting(name):
+    """One SQL Server setting, from the environment first, then Streamlit secrets."""
+    value = os.environ.get(name)
+    if value is None:
+        import streamlit as st  # secrets only exist inside the Streamlit app
+        try:
+            value = st.secrets.get(name)
+        except Exception:
+            value = None  # no secrets.toml at all; report the missing setting below
+    if not value:
+        raise RuntimeError(
+            f"SQL Server setting {name} is not configured; "
+            f"set {', '.join(SQL_SETTINGS)} in the environment or .streamlit/secrets.toml."
+        )
+    return value
+
+@lru_cache(maxsize=1)
+def _connection_string():
+    """Build the SQL Server connection string once per process (one pooling key for the driver manager)."""
+    drivers = [d for d in pyodbc.drivers() if "SQL Server" in d]
+    if not drivers:
+        raise RuntimeError("No SQL Server ODBC drivers found.")
+    server, database, username, password = (_setting(name) for name in SQL_SETTINGS)
+    return (
+        f"DRIVER={{{drivers[-1]}}};"
+        f"SERVER={server};"
+        f"DATABASE={database};"
+        f"UID={username};"
+        f"PWD={password};"
+        "Encrypt=yes;"
+        "TrustServerCertificate=yes;"
+    )
+
+POOL_SIZE = 4  # idle connections kept open per process
+
+pyodbc.pooling = True  # let the ODBC driver manager reuse handshakes as well
 
 def connect():
     """Establish connection to remote SQL Server database."""
-    conn_str = (
-        f"DRIVER={{ODBC Driver 17 for SQL Server}};"
-        f"SERVER={SERVER};"
-        f"DATABASE={DATABASE};"
-        f"UID={USERNAME};"
-        f"PWD={PASSWORD}"
-    )
-    return pyodbc.connect(conn_str)
+    return pyodbc.connect(_connection_string(), autocommit=False)
+
+_POOL = queue.LifoQueue(maxsize=POOL_SIZE)
+
+# Checked out of the pool in one round trip: pings the session (the server may have
+# dropped it while idle) and undoes session state the previous borrower changed
+_CHECKOUT_SQL = """
+    IF @@TRANCOUNT > 0 ROLLBACK;
+    SET NOCOUNT OFF;
+    SET XACT_ABORT OFF;
+    SELECT 1;
+"""
+
+def _checkout():
+    """Take a live connection from the pool, or open a new one if none is usable."""
+    while True:
+        try:
+            conn = _POOL.get_nowait()
+        except queue.Empty:
+            return connect()
+        try:
+            conn.execute(_CHECKOUT_SQL).close()
+            return conn
+        except pyodbc.Error:
+            try:
+                conn.close()  # dead session; drop it and try the next one
+            except pyodbc.Error:
+                pass
+
+@contextmanager
+def pooled_connection():
+    """Borrow a pooled connection (shared by every page); it goes back to the pool on exit."""
+    conn = _checkout()
+    try:
+        yield conn
+    except Exception:
+        conn.close()  # may be broken; don't hand it out again
+        raise
+    try:
+        conn.rollback()  # leave no open transaction behind
+        _POOL.put_nowait(conn)
+    except (pyodbc.Error, queue.Full):
+        conn.close()
+
+_SCHEMA_INITIALIZED = False  # set once the DDL checks have run in this process
 
 def init_db():
     """Create tables if they do not exist (SQL Server syntax)."""
+    global _SCHEMA_INITIALIZED
+    if _SCHEMA_INITIALIZED:
+        return
     conn = connect()
     cur = conn.cursor()
 
@@ -35,6 +113,43 @@ def init_db():
         )
     """)
 
+    # Tables created before the UNIQUE constraint get a filtered unique index instead;
+    # duplicate numbers block it, and it is re-checked at every app start until they are merged
+    cur.execute("""
+        IF NOT EXISTS (
+            SELECT 1 FROM sys.indexes i
+            JOIN sys.index_columns ic ON ic.object_id = i.object_id AND ic.index_id = i.index_id
+            WHERE i.object_id = OBJECT_ID('customers') AND i.is_unique = 1
+              AND COL_NAME(ic.object_id, ic.column_id) = 'customer_number'
+        )
+        AND NOT EXISTS (
+            SELECT customer_number FROM customers
+            WHERE customer_number IS NOT NULL
+            GROUP BY customer_number HAVING COUNT(*) > 1
+        )
+        CREATE UNIQUE INDEX UX_customers_number ON customers(customer_number)
+            WHERE customer_number IS NOT NULL
+    """)
+
+    # Customer id sequence, continuing after any existing CUST-NNNN ids
+    cur.execute("""
+        IF NOT EXISTS (SELECT * FROM sys.sequences WHERE name='customer_seq')
+        BEGIN
+            DECLARE @start INT = (
+                SELECT ISNULL(MAX(TRY_CAST(SUBSTRING(customer_id, 6, 20) AS INT)), 0) + 1
+                FROM customers WHERE customer_id LIKE 'CUST-%'
+            );
+            DECLARE @sql NVARCHAR(200) =
+                N'CREATE SEQUENCE customer_seq AS INT START WITH ' + CAST(@start AS NVARCHAR(20));
+            EXEC sp_executesql @sql;
+        END
+    """)
+    cur.execute("""
+        IF OBJECT_ID('DF_customers_customer_id', 'D') IS NULL
+        ALTER TABLE customers ADD CONSTRAINT DF_customers_customer_id
+            DEFAULT ('CUST-' + FORMAT(NEXT VALUE FOR customer_seq, '0000')) FOR customer_id
+    """)
+
     # Inventory
     cur.execute("""
         IF NOT EXISTS (SELECT * FROM sysobjects WHERE name='inventory' AND xtype='U')
@@ -45,6 +160,13 @@ def init_db():
             safety_stock FLOAT DEFAULT 0
         )
     """)
+    # Older inventory tables predate safety_stock; schema migrations run here, at app boot
+    cur.execute("""
+        IF COL_LENGTH('inventory', 'safety_stock') IS NULL
+        ALTER TABLE inventory
+        ADD safety_stock FLOAT NULL
+        CONSTRAINT DF_inventory_safety_stock DEFAULT 0 WITH VALUES
+    """)
 
     # Inventory Logs
     cur.execute("""
@@ -75,6 +197,13 @@ def init_db():
             FOREIGN KEY (customer_id) REFERENCES customers(customer_id)
         )
     """)
+    # Ongoing-order lookups seek on status instead of grouping the whole table
+    cur.execute("""
+        IF COL_LENGTH('billing', 'status') IS NOT NULL
+           AND NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_billing_status_invoice')
+        EXEC('CREATE INDEX IX_billing_status_invoice ON billing(status, invoice_id)
+              INCLUDE (customer_id, total, [timestamp], product_id, product_name, quantity, unit_price)')
+    """)
 
     # BOM
     cur.execute("""
@@ -90,34 +219,91 @@ def init_db():
 
     conn.commit()
     conn.close()
+    _SCHEMA_INITIALIZED = True
 
 def query_db(query, params=(), fetch=False, many=False, seq=None, ignore_errors=False):
     """Execute a database query."""
-    conn = connect()
-    cur = conn.cursor()
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        try:
+            if many and seq is not None:
+                cur.fast_executemany = True  # ship the whole batch in one round trip
+                cur.executemany(query, seq)
+            else:
+                cur.execute(query, params)
+
+            rows = cur.fetchall() if fetch else None
+            conn.commit()
+            return rows
+        except Exception:
+            if not ignore_errors:
+                raise
+            return None
+        finally:
+            cur.close()
+
+@contextmanager
+def transaction():
+    """Yield a cursor whose statements commit together, or roll back on error."""
+    with pooled_connection() as conn:
+        cur = conn.cursor()
+        try:
+            yield cur
+            conn.commit()
+        finally:
+            cur.close()
+
+# --- Cache invalidation ---
+# Cached readers register under a topic ("billing", "inventory", "orders"); writers clear
+# by topic instead of importing other pages just to reach their caches.
+_CACHE_CLEARERS = {}
+
+def cached_reader(*topics):
+    """Register a Streamlit-cached function so invalidate_caches(topic) clears it."""
+    def register(fn):
+        for topic in topics:
+            # keyed by name so a module reloaded by Streamlit replaces its old entry
+            _CACHE_CLEARERS.setdefault(topic, {})[(fn.__module__, fn.__qualname__)] = fn.clear
+        return fn
+    return register
+
+def invalidate_caches(*topics):
+    """Clear every cached reader registered under the given topics (unimported pages hold no cache)."""
+    for topic in topics:
+        for clear in list(_CACHE_CLEARERS.get(topic, {}).values()):
+            clear()
+
+# Parameter types for inventory stage rows: (ingredient, quantity, unit, safety_stock)
+INVENTORY_STAGE_TYPES = [
+    (pyodbc.SQL_WVARCHAR, 255, 0),  # ingredient
+    (pyodbc.SQL_DOUBLE, 0, 0),      # quantity
+    (pyodbc.SQL_WVARCHAR, 50, 0),   # unit
+    (pyodbc.SQL_DOUBLE, 0, 0),      # safety_stock
+]
+
+def stage_rows(cur, create_sql, insert_sql, types, rows):
+    """Create a temp stage table and bulk-load rows into it with one fast_executemany batch."""
+    cur.execute(create_sql)
+    if not rows:
+        return
+    # Types are pinned so fast_executemany binds one typed buffer instead of
+    # deriving (and re-sizing) parameter types from the Python values
+    cur.fast_executemany = True
+    cur.setinputsizes(types)
     try:
-        if many and seq is not None:
-            cur.executemany(query, seq)
-        else:
-            cur.execute(query, params)
-
-        rows = cur.fetchall() if fetch else None
-        conn.commit()
-        return rows
-    except Exception:
-        if not ignore_errors:
-            raise
-        return None
+        cur.executemany(insert_sql, rows)
     finally:
-        conn.close()
+        cur.setinputsizes(None)
+
+def values_clause(rows):
+    """Build a VALUES row list of placeholders and its flattened params."""
+    placeholder = "(" + ", ".join("?" * len(rows[0])) + ")"
+    return ", ".join([placeholder] * len(rows)), [v for row in rows for v in row]
 
 def fetch_df(sql, params=()):
     """Fetch results into a Pandas DataFrame."""
-    conn = connect()
-    try:
+    with pooled_connection() as conn:
         return pd.read_sql(sql, conn, params=params)
-    finally:
-        conn.close()
 
 def upsert_inventory_row(ingredient, unit):
     """Ensure inventory row exists or update its unit."""
@@ -133,16 +319,30 @@ def upsert_inventory_row(ingredient, unit):
 
 def replace_inventory(df):
     """Replace inventory table with new data from a DataFrame."""
-    conn = connect()
-    cur = conn.cursor()
-    try:
-        cur.execute("TRUNCATE TABLE inventory")
-
-        for _, row in df.iterrows():
-            cur.execute(
-                "INSERT INTO inventory (ingredient, quantity, unit, safety_stock) VALUES (?, ?, ?, ?)",
-                (row["ingredient"], row["quantity"], row["unit"], row.get("safety_stock", 0.0))
-            )
-        conn.commit()
-    finally:
-        conn.close()
+    # plain str/float values keep fast_executemany on its array-binding path
+    safety = df["safety_stock"] if "safety_stock" in df.columns else pd.Series(0.0, index=df.index)
+    rows = list(zip(
+        df["ingredient"].astype(str).tolist(),
+        pd.to_numeric(df["quantity"], errors="coerce").fillna(0.0).astype(float).tolist(),
+        df["unit"].fillna("").astype(str).tolist(),
+        pd.to_numeric(safety, errors="coerce").fillna(0.0).astype(float).tolist(),
+    ))
+    with transaction() as cur:
+        # load the new rows into a stage first so inventory is only empty inside one statement batch
+        stage_rows(
+            cur,
+            """
+                CREATE TABLE #tmp_inv (
+                    ingredient NVARCHAR(255), quantity FLOAT, unit NVARCHAR(50), safety_stock FLOAT
+                )
+            """,
+            "INSERT INTO #tmp_inv VALUES (?, ?, ?, ?)",
+            INVENTORY_STAGE_TYPES,
+            rows,
+        )
+        cur.execute("""
+            TRUNCATE TABLE inventory;
+            INSERT INTO inventory (ingredient, quantity, unit, safety_stock)
+            SELECT ingredient, quantity, unit, ISNULL(safety_stock, 0) FROM #tmp_inv;
+            DROP TABLE #tmp_inv;
+        """)
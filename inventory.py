@@ -2,48 +2,86 @@ import streamlit as st
 import pandas as pd
 from datetime import datetime, timedelta
 
-from db import init_db, fetch_df, query_db
+from db import (
+    init_db, fetch_df, query_db, transaction, values_clause, stage_rows,
+    cached_reader, invalidate_caches, INVENTORY_STAGE_TYPES,
+)
 from bom_handler import ensure_bom_seeded, INGREDIENT_UNITS, DEFAULT_BOM
 
 # Admin credentials
 ADMIN_ID = "123"
 ADMIN_PASS = "456"
 
+# --- Save-path SQL, built once per process ---
+_INV_STAGE_SQL = """
+    DROP TABLE IF EXISTS #inv_stage;
+    CREATE TABLE #inv_stage (
+        ingredient NVARCHAR(255),
+        quantity FLOAT,
+        unit NVARCHAR(50),
+        safety_stock FLOAT
+    );
+"""
+_INV_STAGE_INSERT = "INSERT INTO #inv_stage VALUES (?, ?, ?, ?)"
+# OUTPUT hands back the before/after quantity of every row the MERGE touched;
+# NOCOUNT is scoped to this batch so it never outlives the statement
+_INV_MERGE_SQL = """
+    SET NOCOUNT ON;
+    MERGE inventory WITH (TABLOCK) AS target
+    USING #inv_stage AS source
+    ON target.ingredient = source.ingredient
+    WHEN MATCHED THEN
+        UPDATE SET 
+            quantity = source.quantity,
+            unit = source.unit,
+            safety_stock = source.safety_stock
+    WHEN NOT MATCHED THEN
+        INSERT (ingredient, quantity, unit, safety_stock)
+        VALUES (source.ingredient, source.quantity, source.unit, source.safety_stock)
+    OUTPUT inserted.ingredient, deleted.quantity, inserted.quantity;
+    SET NOCOUNT OFF;
+"""
+_INV_LOG_INSERT = """
+    INSERT INTO inventory_logs
+        (ingredient, change_type, quantity_changed, old_quantity, new_quantity, timestamp, use_before)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
 # --- DB helpers ---
-def ensure_safety_stock_column():
-    query_db("""
-        IF COL_LENGTH('inventory', 'safety_stock') IS NULL
-        BEGIN
-            ALTER TABLE inventory 
-            ADD safety_stock FLOAT NULL 
-            CONSTRAINT DF_inventory_safety_stock DEFAULT 0 WITH VALUES;
-        END
-    """, ignore_errors=True)
-
-def get_all_bom_ingredients():
-    ingredients = []
-    for recipe in DEFAULT_BOM.values():
-        for ing in recipe.keys():
-            if ing not in ingredients:
-                ingredients.append(ing)
-    return ingredients
+def get_all_bom_ingredients() -> tuple[str, ...]:
+    """Distinct BOM ingredients in first-seen order."""
+    return tuple(dict.fromkeys(ing for recipe in DEFAULT_BOM.values() for ing in recipe))
+
+# BOM ingredients and their units, aligned, resolved once at import
+_BOM_INGREDIENTS = get_all_bom_ingredients()
+_BOM_UNITS = tuple(INGREDIENT_UNITS.get(ing, "") for ing in _BOM_INGREDIENTS)
+
+_BOM_SYNCED = False  # set once the BOM ingredients are known to be in inventory in this process
 
 def sync_inventory_with_bom():
     """Insert BOM ingredients if missing, keep existing ones."""
+    global _BOM_SYNCED
+    if _BOM_SYNCED:
+        return
     ensure_bom_seeded()
-    ensure_safety_stock_column()
-    ingredients = get_all_bom_ingredients()
-    for ing in ingredients:
-        unit = INGREDIENT_UNITS.get(ing, "")
-        query_db("""
-            MERGE inventory AS target
-            USING (SELECT ? AS ingredient, CAST(0 AS FLOAT) AS quantity, ? AS unit, CAST(0 AS FLOAT) AS safety_stock) AS source
-            ON target.ingredient = source.ingredient
-            WHEN NOT MATCHED THEN
-                INSERT (ingredient, quantity, unit, safety_stock)
-                VALUES (source.ingredient, source.quantity, source.unit, source.safety_stock);
-        """, (ing, unit))
+    if not _BOM_INGREDIENTS:
+        _BOM_SYNCED = True
+        return
+    # one MERGE over all ingredients instead of one per row
+    values_sql, params = values_clause(list(zip(_BOM_INGREDIENTS, _BOM_UNITS)))
+    query_db(f"""
+        MERGE inventory AS target
+        USING (VALUES {values_sql}) AS source (ingredient, unit)
+        ON target.ingredient = source.ingredient
+        WHEN NOT MATCHED THEN
+            INSERT (ingredient, quantity, unit, safety_stock)
+            VALUES (source.ingredient, CAST(0 AS FLOAT), source.unit, CAST(0 AS FLOAT));
+    """, params)
+    invalidate_caches("inventory")  # newly inserted rows must show up in the grid
+    _BOM_SYNCED = True
 
+@cached_reader("inventory")
+@st.cache_data(ttl=30, show_spinner=False)
 def load_full_inventory_df():
     """Load the full inventory without dropping any rows."""
     df = fetch_df("""
@@ -55,6 +93,8 @@ def load_full_inventory_df():
     """)
     if df is None:
         df = pd.DataFrame(columns=["Ingredient", "Quantity", "Unit", "Safety Stock"])
+    # small fixed vocabulary; Unit stays str so the editor keeps it free-text
+    df["Ingredient"] = df["Ingredient"].astype("category")
     return df
 
 # --- Name normalization for shelf-life lookup ---
@@ -71,138 +111,150 @@ NAME_ALIASES = {
     "Cup Size (total cups)": "Cup Size (total cups)",
 }
 
-def _get_shelf_life_days(ingredient: str) -> int | None:
+def _load_shelf_life_map() -> dict[str, int]:
     """
-    Fetch shelf_life_days from SQL Server.
+    Fetch every shelf-life entry from SQL Server in one pass, keyed by trimmed upper-case name.
     - Prefer table:  shelf_life (ingredient, shelf_life_days)
     - Fallback:      self_life  (ingredient, self_life_days)
-    Matching is trimmed and case-insensitive.
     """
+    shelf_map: dict[str, int] = {}
+    # Legacy table first so entries from the correct table override it.
+    for sql in (
+        "SELECT ingredient, self_life_days FROM self_life",
+        "SELECT ingredient, shelf_life_days FROM shelf_life",
+    ):
+        try:
+            df = fetch_df(sql)
+        except Exception:
+            # Either table may be missing in some envs.
+            continue
+        if df is None or df.empty:
+            continue
+        for ing, days in df.itertuples(index=False, name=None):
+            if ing is not None and pd.notna(days):
+                shelf_map[str(ing).strip().upper()] = int(days)
+    return shelf_map
+
+def _get_shelf_life_days(ingredient: str, shelf_map: dict[str, int]) -> int | None:
+    """Shelf life for an ingredient from the prefetched map; matching is trimmed and case-insensitive."""
     ing = NAME_ALIASES.get(ingredient.strip(), ingredient.strip())
+    return shelf_map.get(ing.strip().upper())
 
-    # Try the correct table/column first.
-    try:
-        df = fetch_df(
-            """
-            SELECT TOP 1 shelf_life_days
-            FROM shelf_life
-            WHERE UPPER(LTRIM(RTRIM(ingredient))) = UPPER(LTRIM(RTRIM(?)))
-            """,
-            (ing,),
-        )
-        if df is not None and not df.empty:
-            val = df.iloc[0]["shelf_life_days"]
-            if pd.notna(val):
-                return int(val)
-    except Exception:
-        # If shelf_life table isn't present in some envs, try the legacy name.
-        pass
-
-    # Legacy table/column name (only if present)
-    try:
-        df2 = fetch_df(
-            """
-            SELECT TOP 1 self_life_days
-            FROM self_life
-            WHERE UPPER(LTRIM(RTRIM(ingredient))) = UPPER(LTRIM(RTRIM(?)))
-            """,
-            (ing,),
-        )
-        if df2 is not None and not df2.empty:
-            val2 = df2.iloc[0]["self_life_days"]
-            if pd.notna(val2):
-                return int(val2)
-    except Exception:
-        pass
-
-    return None
-
-def log_inventory_change(ingredient, old_qty, new_qty):
-    """Insert inventory change into logs, including use_before date derived from shelf_life."""
-    try:
-        if old_qty is None or new_qty is None:
-            return
-
-        old_qty = float(old_qty)
-        new_qty = float(new_qty)
-        diff = new_qty - old_qty
-        if diff == 0:
-            return
-
-        change_type = "Added" if diff > 0 else "Wasted"
-
-        # Look up shelf life strictly from DB (no arbitrary fallback).
-        days = _get_shelf_life_days(str(ingredient))
-        ts_now = datetime.now()
-        use_before = (ts_now + timedelta(days=days)).date() if days and days > 0 else None
-
-        query_db(
-            """
-            INSERT INTO inventory_logs
-                (ingredient, change_type, quantity_changed, old_quantity, new_quantity, timestamp, use_before)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-            """,
-            (
-                str(ingredient),
-                change_type,
-                float(abs(diff)),
-                old_qty,
-                new_qty,
-                ts_now,
-                use_before,
-            ),
-        )
-    except Exception as e:
-        print(f"[ERROR] log_inventory_change failed: {e}")
+def log_inventory_change(ingredient, old_qty, new_qty, shelf_map, ts_now=None):
+    """Build an inventory_logs row (with use_before derived from shelf_life), or None if nothing changed."""
+    if old_qty is None or new_qty is None:
+        return None
+
+    old_qty = float(old_qty)
+    new_qty = float(new_qty)
+    diff = new_qty - old_qty
+    if diff == 0:
+        return None
+
+    change_type = "Added" if diff > 0 else "Wasted"
+
+    # Look up shelf life strictly from DB (no arbitrary fallback).
+    days = _get_shelf_life_days(str(ingredient), shelf_map)
+    ts_now = ts_now or datetime.now()
+    use_before = (ts_now + timedelta(days=days)).date() if days and days > 0 else None
+
+    return (
+        str(ingredient),
+        change_type,
+        float(abs(diff)),
+        old_qty,
+        new_qty,
+        ts_now,
+        use_before,
+    )
 
 def save_inventory_df(df: pd.DataFrame):
     """Upsert inventory changes and log them."""
-    for _, row in df.iterrows():
-        ing = row["Ingredient"].strip()
-        new_qty = float(row["Quantity"]) if pd.notna(row["Quantity"]) else 0.0
-        unit = row.get("Unit", "") or ""
-        safety_stock = float(row.get("Safety Stock", 0.0)) if pd.notna(row.get("Safety Stock", 0.0)) else 0.0
-
-        # Get old quantity (None if not found)
-        old_qty_row = fetch_df("SELECT quantity FROM inventory WHERE ingredient = ?", (ing,))
-        old_qty = old_qty_row.iloc[0]["quantity"] if old_qty_row is not None and not old_qty_row.empty else None
-
-        # Upsert inventory
-        query_db(
-            """
-            MERGE inventory AS target
-            USING (SELECT ? AS ingredient, ? AS quantity, ? AS unit, ? AS safety_stock) AS source
-            ON target.ingredient = source.ingredient
-            WHEN MATCHED THEN
-                UPDATE SET 
-                    quantity = source.quantity,
-                    unit = source.unit,
-                    safety_stock = source.safety_stock
-            WHEN NOT MATCHED THEN
-                INSERT (ingredient, quantity, unit, safety_stock)
-                VALUES (source.ingredient, source.quantity, source.unit, source.safety_stock);
-            """,
-            (str(ing), float(new_qty), str(unit), float(safety_stock)),
-        )
-
-        # Log change if there was an existing record
-        if old_qty is not None:
-            log_inventory_change(ing, old_qty, new_qty)
+    if df.empty:
+        return
+
+    ingredients = df["Ingredient"].astype(str).str.strip().tolist()
+    quantities = pd.to_numeric(df["Quantity"], errors="coerce").fillna(0.0).astype(float).tolist()
+    units = (df["Unit"].fillna("").astype(str) if "Unit" in df else pd.Series("", index=df.index)).tolist()
+    safety_stock = (
+        pd.to_numeric(df["Safety Stock"], errors="coerce").fillna(0.0).astype(float)
+        if "Safety Stock" in df else pd.Series(0.0, index=df.index)
+    ).tolist()
+
+    # Current values for every ingredient in one query (missing -> inserted, not logged)
+    old_df = fetch_df("SELECT ingredient, quantity, unit, safety_stock FROM inventory")
+    if old_df is None:
+        old_df = pd.DataFrame(columns=["ingredient", "quantity", "unit", "safety_stock"])
+    old_qty = dict(zip(old_df["ingredient"], old_df["quantity"]))
+    ing_s = pd.Series(ingredients, dtype=object)
+    old_s = ing_s.map(old_qty).astype(float)
+
+    # Existing records whose quantity moved (these will produce log entries)
+    changed = old_s.notna() & (pd.Series(quantities, dtype=float) != old_s)
+
+    # Rows that need writing at all: new ingredients or any edited column
+    old_unit = ing_s.map(dict(zip(old_df["ingredient"], old_df["unit"]))).fillna("").astype(str)
+    old_ss = ing_s.map(dict(zip(old_df["ingredient"], old_df["safety_stock"]))).astype(float).fillna(0.0)
+    dirty = (
+        ~ing_s.isin(old_df["ingredient"])
+        | changed
+        | (pd.Series(units, dtype=object) != old_unit)
+        | (pd.Series(safety_stock, dtype=float) != old_ss)
+    )
+    if not dirty.any():
+        return  # Save pressed without edits
+
+    # Fetch shelf lives up front so nothing remote runs while the MERGE holds its lock
+    shelf_map = {}
+    if changed.any():
+        try:
+            shelf_map = _load_shelf_life_map()
+        except Exception as e:
+            # logs are still written, just without a use_before date
+            print(f"[ERROR] shelf-life lookup failed; logging without use_before: {e}")
+
+    # Upsert and log in one transaction: stage the edited rows, then one set-based MERGE
+    rows = [row for row, d in zip(zip(ingredients, quantities, units, safety_stock), dirty.tolist()) if d]
+    with transaction() as cur:
+        stage_rows(cur, _INV_STAGE_SQL, _INV_STAGE_INSERT, INVENTORY_STAGE_TYPES, rows)
+        cur.execute(_INV_MERGE_SQL)
+        outcome = cur.fetchall()
+        while cur.nextset():  # let the trailing SET NOCOUNT OFF run
+            pass
+        cur.execute("DROP TABLE #inv_stage;")
+
+        # Inserted rows have no deleted.quantity and are skipped, as before
+        ts_now = datetime.now()
+        logs = [
+            log_inventory_change(ing, old, new_qty, shelf_map, ts_now)
+            for ing, old, new_qty in outcome
+        ]
+        logs = [row for row in logs if row is not None]
+        if logs:
+            # stock update and its log commit together or not at all
+            cur.executemany(_INV_LOG_INSERT, logs)
+
+def _display_names(ingredients: pd.Series, units: pd.Series) -> pd.Series:
+    """Grid labels: ingredient with its unit appended, built column-wise."""
+    units = units.fillna("").astype(str)
+    labelled = ingredients.astype(str) + " (" + units + ")"
+    return labelled.where(units != "", ingredients)
+
+@st.cache_data(ttl=30, max_entries=4, show_spinner=False)
+def build_display_df(df: pd.DataFrame) -> pd.DataFrame:
+    """Inventory frame with display labels; keyed on the frame's contents so edits never hit a stale entry."""
+    return df.assign(Ingredient=_display_names(df["Ingredient"], df["Unit"]))
 
 # --- UI Page ---
 def inventory_page():
-    init_db()
     st.header("📦 Inventory Management")
 
+    init_db()
     sync_inventory_with_bom()
     df = load_full_inventory_df()
 
     # Visual: append unit to ingredient for display only
-    df_disp = df.copy()
-    df_disp["Ingredient"] = [
-        f"{ing} ({unit})" if unit else ing
-        for ing, unit in zip(df["Ingredient"], df["Unit"])
-    ]
+    df_disp = build_display_df(df)
 
     st.markdown(
         """
@@ -243,14 +295,22 @@ def inventory_page():
 
     if st.session_state.inventory_edit_enabled:
         st.success("✅ Editing enabled. Update inventory values below.")
-        edited = st.data_editor(df_disp, num_rows="fixed", use_container_width=True, height=800)
-        edited["Ingredient"] = df["Ingredient"]  # map back to raw names
+        # Edits stay client-side until Save; the form submits them in one rerun
+        with st.form("inv_edit"):
+            edited = st.data_editor(df_disp, num_rows="fixed", use_container_width=True, height=800)
+            submitted = st.form_submit_button("💾 Save Inventory")
 
-        if st.button("💾 Save Inventory"):
-            save_inventory_df(edited)
-            st.success("Inventory saved successfully! Changes logged in history.")
-            st.session_state.inventory_edit_enabled = False
-            st.rerun()
+        if submitted:
+            edited["Ingredient"] = df["Ingredient"]  # map back to raw names
+            try:
+                save_inventory_df(edited)
+            except Exception as e:
+                st.error(f"Inventory was not saved: {e}")
+            else:
+                invalidate_caches("inventory")
+                st.success("Inventory saved successfully! Changes logged in history.")
+                st.session_state.inventory_edit_enabled = False
+                st.rerun()
 
     if not st.session_state.inventory_edit_enabled and not st.session_state.login_prompt:
         st.dataframe(df_disp, use_container_width=True, height=800)
@@ -1,77 +1,96 @@
 import streamlit as st
 import pandas as pd
-from db import fetch_df, query_db
-from bom_handler import calculate_deduction, ensure_bom_seeded, INGREDIENT_UNITS
+from db import fetch_df, query_db, transaction, cached_reader, invalidate_caches
+from bom_handler import calculate_deduction, ensure_bom_seeded
 
-def order_management_page():
-    ensure_bom_seeded()  # Make sure BOM is ready
-    st.title("📦 Order Management")
-
-    # Fetch grouped orders
-    orders_df = fetch_df("""
+@cached_reader("orders")
+@st.cache_data(ttl=10, show_spinner=False)
+def load_ongoing_orders_df():
+    """Ongoing orders grouped per invoice; cleared whenever an order is saved, done or canceled."""
+    return fetch_df("""
         SELECT 
             invoice_id,
             customer_id,
             SUM(total) AS total_amount,
-            MIN(timestamp) AS order_time,
-            status
+            MIN(timestamp) AS order_time
         FROM billing
-        GROUP BY invoice_id, customer_id, status
-        HAVING status = 'ongoing'
+        WHERE status = 'ongoing'
+        GROUP BY invoice_id, customer_id
         ORDER BY order_time ASC
     """)
 
+@cached_reader("orders")
+@st.cache_data(ttl=10, show_spinner=False)
+def load_ongoing_order_items_df():
+    """Line items of every ongoing order in one query; cleared with the other "orders" readers."""
+    return fetch_df("""
+        SELECT invoice_id, product_id, product_name, quantity, unit_price, total
+        FROM billing
+        WHERE status = 'ongoing'
+    """)
+
+def order_management_page():
+    ensure_bom_seeded()  # Make sure BOM is ready
+    st.title("📦 Order Management")
+
+    # Fetch grouped orders
+    orders_df = load_ongoing_orders_df()
+
     if orders_df.empty:
         st.info("No ongoing orders at the moment.")
         return
 
-    for _, row in orders_df.iterrows():
-        with st.expander(f"🧾 Order {row['invoice_id']} - Customer {row['customer_id']}"):
-            st.write(f"**Total Amount:** ₹{row['total_amount']}")
-            st.write(f"**Order Time:** {row['order_time']}")
+    # Items for all orders at once, split per invoice
+    items_by_id = {
+        invoice_id: items.drop(columns="invoice_id").reset_index(drop=True)
+        for invoice_id, items in load_ongoing_order_items_df().groupby("invoice_id", sort=False)
+    }
+    no_items = pd.DataFrame(columns=["product_id", "product_name", "quantity", "unit_price", "total"])
+
+    for row in orders_df.itertuples(index=False):
+        with st.expander(f"🧾 Order {row.invoice_id} - Customer {row.customer_id}"):
+            st.write(f"**Total Amount:** ₹{row.total_amount}")
+            st.write(f"**Order Time:** {row.order_time}")
 
             # Show items for this invoice
-            items_df = fetch_df("""
-                SELECT product_id, product_name, quantity, unit_price, total
-                FROM billing
-                WHERE invoice_id = ?
-            """, (row['invoice_id'],))
+            items_df = items_by_id.get(row.invoice_id, no_items)
             st.table(items_df)
 
             col1, col2 = st.columns(2)
 
             # ✅ Mark as Done
             with col1:
-                if st.button("✅ Mark as Done", key=f"done_{row['invoice_id']}"):
+                if st.button("✅ Mark as Done", key=f"done_{row.invoice_id}"):
                     query_db(
                         "UPDATE billing SET status = 'done' WHERE invoice_id = ?",
-                        (row['invoice_id'],)
+                        (row.invoice_id,)
                     )
-                    st.success(f"Order {row['invoice_id']} marked as done.")
+                    invalidate_caches("orders")
+                    st.success(f"Order {row.invoice_id} marked as done.")
                     st.rerun()
 
             # ❌ Cancel Order — restore inventory
             with col2:
-                if st.button("❌ Cancel Order", key=f"cancel_{row['invoice_id']}"):
-                    # Restore inventory
-                    cart_items = items_df.to_dict(orient="records")
-                    if cart_items:
-                        from billing import ensure_inventory_rows_exist  # reuse from billing.py
-                        deduction = calculate_deduction(cart_items)
-                        if deduction:
-                            ensure_inventory_rows_exist(list(deduction.keys()))
-                            for ing, qty in deduction.items():
-                                query_db(
-                                    "UPDATE inventory SET quantity = ISNULL(quantity, 0) + ? WHERE ingredient = ?",
-                                    (float(qty), ing)
-                                )
+                if st.button("❌ Cancel Order", key=f"cancel_{row.invoice_id}"):
+                    from billing import deduct_inventory  # reuse from billing.py
+                    deduction = calculate_deduction(items_df.to_dict(orient="records"))
 
-                    # Update order status
-                    query_db(
-                        "UPDATE billing SET status = 'canceled' WHERE invoice_id = ?",
-                        (row['invoice_id'],)
-                    )
-                    st.warning(f"Order {row['invoice_id']} canceled and inventory restored.")
+                    # Status change and stock restore commit together; an order
+                    # already closed elsewhere updates no rows and restores nothing
+                    with transaction() as cur:
+                        canceled = cur.execute(
+                            "UPDATE billing SET status = 'canceled' OUTPUT inserted.invoice_id "
+                            "WHERE invoice_id = ? AND status = 'ongoing'",
+                            (row.invoice_id,)
+                        ).fetchall()
+                        if canceled and deduction:
+                            # one MERGE: a negative deduction adds stock back, creating missing rows
+                            deduct_inventory(cur, {ing: -float(qty) for ing, qty in deduction.items()})
+                    invalidate_caches("inventory", "orders")
+                    if canceled:
+                        st.warning(f"Order {row.invoice_id} canceled and inventory restored.")
+                    else:
+                        st.info(f"Order {row.invoice_id} was already canceled/closed.")
                     st.rerun()
 
 if __name__ == "__main__":